@@ -58,6 +58,19 @@ alignment produce an multiple sequence alignment that only includes SNPs.
 Regions with gaps or have no informative sites are stripped out. This improves
 runtime for trees based on a large number of genes.
 
+Genomes are passed through a pipeline (convert, search, parse, aggregate,
+align) with a thread per stage, so GenBank conversion and parsing of BLAST 
+results happen while BLAST is running on other genomes. The '-q' option sets
+how many genomes can wait between stages. Time spent in each stage and queue
+depths are printed at the end to show the bottleneck stage.
+
+Use '-z gzip' or '-z zstd' to compress the files in temp/, fas/, aln/ and phy/
+and the concatenated alignments (zstd needs the zstandard module, otherwise 
+gzip is used). BLAST and MUSCLE read and write these files as streams, so 
+nothing is decompressed to disk. PhyML cannot read compressed files, so phylip
+files stay uncompressed with '-t'. '-L' sets the compression level. The bytes 
+written and time spent writing each kind of file are printed at the end.
+
 Run the worked example 'Dryad-Example.py' to see the script's output.
 
 ### CHANGE LOG ### 
@@ -70,11 +83,16 @@ import traceback
 import optparse
 import time
 import re
+import threading
+import Queue
+import gzip
+import io
+import shutil
 from Bio.Blast.Applications import NcbiblastxCommandline
 from Bio.Blast.Applications import NcbiblastnCommandline
 from Bio.Blast.Applications import NcbiblastpCommandline
 from Bio.Blast import NCBIXML
-from Bio.Seq import Seq
+from Bio.Seq import Seq, reverse_complement
 from Bio.SeqRecord import SeqRecord
 from Bio import SeqIO
 from Bio.Alphabet import generic_protein, generic_dna
@@ -84,6 +102,10 @@ from Bio import AlignIO
 from Bio.Align.Applications import MuscleCommandline
 from Bio.Align import MultipleSeqAlignment
 import subprocess
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #from pexpect import run, spawn
 __author__ = "Nabil-Fareed Alikhan"
@@ -107,6 +129,9 @@ def main():
     if len(args) < 2 or not os.path.isfile(args[1]):
         sys.stderr.write('Filelist is not specified or is not a regular file\n')
         sys.exit(1)
+    if options.queue < 1:
+        sys.stderr.write('Queue size (-q) must be at least 1\n')
+        sys.exit(1)
     if options.eval != None:
         Uevalue = options.eval
     if options.len != None:
@@ -141,12 +166,21 @@ def main():
     # index lengths of database genes
     if not os.path.exists('temp'):
         os.mkdir('temp')
-    f = open(outFile + 'table.csv', 'w')
+    # PhyML can only read plain phylip files
+    plain = []
+    if options.tree:
+        plain = ['phy']
+    try:
+        comp = Compressor(options.compress, options.level, plain)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        sys.exit(1)
+    # Rows are written per HSP, so give the table a large buffer
+    f = open(outFile + 'table.csv', 'w', 1 << 20)
     header = 'ref_gene\tdesc\tlen\tgenome_file_name\tfasta_entry\tlen\tidentity\tperOflength\te-value\tref_start\tref_stop\tgenome_start\tgenome_stop\tscore\tadded\tsequence'
     if GBK:
         header = header + '\t'+  header 
     f.write(header + '\n')
-    masterOut = []
     masterSeq = {}
 
     # Format BLAST db accordingly
@@ -154,216 +188,86 @@ def main():
     print(  proc.stdout.read())
 
     pre = open(outFile + 'presence.csv','w')
-    # Run BLASTx if protein ref, BLASTn if nucl ref
-    for genome  in genomeList:
-        print 'reading ' + genome 
-        genome = genome.strip()
-        blastRes = 'temp/' + os.path.basename(refPro) + os.path.basename(genome) + dbtype  + '.xml'
-        #repoBlast = 'temp/' + os.path.basename(genome) + os.path.basename(refPro) + dbtype  + '.xml'
-        # if GBK convert to faa, run RBH:
-        if GBK:
-            input_handle  = open(genome, "r")
-            INEXT = '.gbk'
-            INTYPE = 'genbank'
-            if genome.endswith('.embl'):
-                INEXT = '.embl'
-                INTYPE = 'embl'
-            if RefPro:
-                genome = 'temp/' + os.path.basename(genome).replace(INEXT,'.faa')
-            else:
-                genome = 'temp/' + os.path.basename(genome).replace(INEXT,'.fna')
-            print 'checking ' + genome 
-            if not os.path.exists(genome) or os.path.getsize(genome) == 0:
-                output_handle = open(genome, "w")
-                print 'Creating fas: ' + genome 
-                for seq_record in SeqIO.parse(input_handle, INTYPE):
-                    print "Dealing with GenBank record %s" % seq_record.id
-                    for seq_feature in seq_record.features:
-                        if seq_feature.type== "CDS" :
-                            na = ''
-                            labled = True 
-                            if seq_feature.qualifiers.has_key('locus_tag'):
-                                na = seq_feature.qualifiers['locus_tag'][0]  
-                            elif seq_feature.qualifiers.has_key('gene'):
-                                na = seq_feature.qualifiers['gene'][0]
-                            else:
-                                labled = False
-                            if RefPro and labled:
-                                try:
-                                    if seq_feature.qualifiers.has_key('pseudo') == False:
-                                        if not seq_feature.qualifiers.has_key('translation'):
-                                            pr = seq_feature.extract(seq_record.seq)
-                                            seq_feature.qualifiers['translation'] = [pr.translate()]
-                                        output_handle.write(">%s|%s [%s]\n%s\n" % (
-                                            na,
-                                            seq_record.name, seq_feature.qualifiers['product'][0],
-                                            seq_feature.qualifiers['translation'][0]))
-                                except Exception as e:
-                                    print 'ERROR:' +  str(e)
-                                    print seq_feature
-                            elif labled:
-                                try:
-                                    descs = 'pseudogene'
-                                    if  seq_feature.qualifiers.has_key('product'): 
-                                        descs =  seq_feature.qualifiers['product']
-                                    output_handle.write(">%s|%s [%s]\n%s\n" % (
-                                            na,
-                                            seq_record.name, descs,
-                                            seq_feature.extract(seq_record).seq))
-                                except Exception as e:
-                                    print 'ERROR ' + str(e)
-                                    print seq_feature
-                output_handle.close()
-                input_handle.close()
-            #if not os.path.exists(str(genome) + '.phr') and RefPro:
-            #    proc = subprocess.Popen([ "makeblastdb", "-in" , str(genome), "-dbtype", "prot"  ], stdout=subprocess.PIPE)
-            #    print(  proc.stdout.read())
-            if RefPro and (not os.path.exists(blastRes) or os.path.getsize(blastRes) == 0):
-                cline = NcbiblastpCommandline(query=genome, seg='no',db=refPro,evalue=Uevalue,outfmt=5,out=blastRes,num_threads='8')
-                print(str(cline) + '\n')
-                cline()
-            elif not os.path.exists(blastRes) or os.path.getsize(blastRes) == 0:
-                cline = NcbiblastnCommandline(task='blastn',query=genome, dust='no',db=refPro,evalue=Uevalue,outfmt=5,out=blastRes)
-                print(str(cline) + '\n')
-                cline()
-            #if not os.path.exists(repoBlast) or os.path.getsize(repoBlast) == 0:
-            #    cline = NcbiblastpCommandline(query=refPro, seg='no',db=genome,evalue=Uevalue,outfmt=5,out=repoBlast)
-            #    print(str(cline) + '\n')
-            #    cline()
-        else:
-        # else run regular BLAST search
-            if not os.path.exists(blastRes) or os.path.getsize(blastRes) == 0: 
-                cline = '' 
-                if RefPro:
-                    cline = NcbiblastxCommandline(query=genome, seg='no',  db=refPro, evalue=Uevalue, outfmt=5, out=blastRes)
-                else: 
-                    cline = NcbiblastnCommandline(query=genome, dust='no', task='blastn', db=refPro, evalue=Uevalue, outfmt=5, out=blastRes)
-                print(str(cline) + '\n')
-                cline()
-        print 'reading BLAST ' + blastRes
-        result_handle = open(blastRes)
-        blast_records = NCBIXML.parse(result_handle)
-        int_handle  = open(genome, "r")
-        fast = SeqIO.to_dict(SeqIO.parse(int_handle, "fasta"))
-        print 'indexed fasta' 
-        for blast_record in blast_records:
-            for alignment in blast_record.alignments:
-                hits = 0
-                for hsp in alignment.hsps:
-                    outLine  = []
-                    refHead =  alignment.hit_def.split('|')
-		    if refHead[0] == 'gi': refHead = refHead[3:] 
-		    tempdoop = None
-                    if GBK and RefPro:
-                        tempse = fast[blast_record.query.split()[0].strip()]
-			tempdoop = SeqRecord(Seq(str(tempse.seq),generic_protein),id=os.path.basename(genome).split('.')[0],description=refHead[0],name=refHead[1])
-                        if tempdoop == None:
-                            print   'Error:\t' + blast_record.query.split('|')[0]
-                    elif GBK and not RefPro: 
-                        tempse = fast[blast_record.query.split()[0].strip()] 
-                        seqseq = Seq(str(tempse.seq), generic_dna)
-                        if hsp.frame[1] == -1:
-                            seqseq = seqseq.reverse_complement()
-                        tempdoop = SeqRecord(seqseq,id=os.path.basename(genome).split('.')[0],description=refHead[0])
-                        if tempdoop == None:
-                            print  'Error:\t' + blast_record.query.split('|')[0]
-                    elif not GBK and  RefPro:
-                        tempdoop = SeqRecord(Seq(hsp.query, generic_protein), id=os.path.basename(genome).split('.')[0],description=refHead[0] )
-                    else:
-                        seqseq = Seq(hsp.query,generic_dna) 
-                        if hsp.frame[1] == -1:
-                            seqseq = seqseq.reverse_complement()
-                        tempdoop = SeqRecord(seqseq, id=os.path.basename(genome).split('.')[0],description=refHead[-1])
-                    outLine.append(refHead[0])
-                    outLine.append(refHead[-1])
-                    outLine.append(alignment.length)
-                    outLine.append(os.path.basename(genome))
-                    outLine.append(blast_record.query)
-                    outLine.append(blast_record.query_letters)
-                    outLine.append(int(float(hsp.identities) / float(hsp.align_length) * float(100)))
-                    outLine.append(int(float(hsp.align_length) / float(alignment.length) * float(100)))
-                    outLine.append(hsp.expect)
-                    outLine.append(hsp.sbjct_start)
-                    outLine.append(hsp.sbjct_end)
-                    outLine.append(hsp.query_start)
-                    outLine.append(hsp.query_end)
-                    outLine.append(hsp.score)
-                    # IF GENBANK: Append details of reciprocal hit
-                    REPOCHECK = True
-                    #if GBK:
-                    #    print 'check if reprocal hit passes cutoff'
-                    # Grab only first hit, i.e best hit. 
-                    # Create dict (key: ref gene) and add sequences for that gene to an array
-                    if ( REPOCHECK and hits == 0 and float(hsp.identities) / float(hsp.align_length) * float(100)  ) > float(identCutoff) \
-                            and ( float(hsp.align_length) / float(alignment.length) * float(100) > lenCutoff):
-                        hits += 1
-                        outLine.append('1')
-                        if not masterSeq.has_key(outLine[0]):
-                            masterSeq[outLine[0]] = [ tempdoop ]
-                        else:
-                            arry = masterSeq[outLine[0]]
-                            dupe = 0
-                            for rec in arry:
-                                if rec.id == tempdoop.id:
-                                    dupe += 1
-                            if dupe == 0:
-                                arry.append(tempdoop)
-                                masterSeq[ outLine[0] ] = arry
-                    else:
-                        outLine.append('0')
-                    if tempdoop != None: 
-                        outLine.append( tempdoop.seq )
-                    masterOut.append(outLine)
-                    deg = ''
-                    for el in outLine:
-                        deg += str(el) + '\t'
-                    f.write(deg + '\n')
-    f.close()
-    genlist = []
-    for genome in genomeList:
-        genome = genome.strip()
-        tempgen = os.path.basename(genome).split('.')[0]
-        genlist.append(tempgen)
-    genlist.sort()
-    head = ''
-    for ge in genlist:
-        head += ge  +'\t'
-    pre.write('\t'+head +'\n')
-    for do in masterSeq.keys():
-        o =  masterSeq[do][0].description
-        sert = []
-        lin = ''
-        for gen in masterSeq[do]:
-            sert.append(gen.id)
-        for genome in genlist:
-            hasgene = 0
-            for hgene in sert:
-                if hgene == genome:
-                    hasgene += 1 
-            if hasgene > 0:
-                lin += '1\t'
-            else:
-                lin += '0\t' 
-        pre.write(o +'\t' + lin+'\n')
-    pre.close()
     if not os.path.exists('fas'):
         os.mkdir('fas')
-    # Output FASTA files
-    xmfaOut = open(outFile + 'all.xmfa','w')
-    for name in masterSeq.keys():
+    if options.muscle or options.tree or options.xfma:
+        if not os.path.exists('aln'):
+            os.mkdir('aln')
+        if not os.path.exists('phy'):
+            os.mkdir('phy')
+    xmfaOut = comp.open(comp.name(outFile + 'all.xmfa', 'aln'), 'aln')
+
+    # Write presence/absence table of ref genes in each genome
+    def presence():
+        genlist = []
+        for genome in genomeList:
+            genome = genome.strip()
+            tempgen = os.path.basename(genome).split('.')[0]
+            genlist.append(tempgen)
+        genlist.sort()
+        head = ''
+        for ge in genlist:
+            head += ge  +'\t'
+        pre.write('\t'+head +'\n')
+        for do in masterSeq.keys():
+            o =  masterSeq[do][0].description
+            sert = []
+            lin = ''
+            for gen in masterSeq[do]:
+                sert.append(gen.id)
+            for genome in genlist:
+                hasgene = 0
+                for hgene in sert:
+                    if hgene == genome:
+                        hasgene += 1 
+                if hasgene > 0:
+                    lin += '1\t'
+                else:
+                    lin += '0\t' 
+            pre.write(o +'\t' + lin+'\n')
+        pre.close()
+
+    # Create dict (key: ref gene) and add best hit for that gene from each
+    # genome. Once every genome has reported, write the presence table and
+    # release the gene families for alignment.
+    reported = [0]
+    def aggregate(best):
+        for name, tempdoop in best:
+            if not masterSeq.has_key(name):
+                masterSeq[name] = [ tempdoop ]
+            else:
+                arry = masterSeq[name]
+                dupe = 0
+                for rec in arry:
+                    if rec.id == tempdoop.id:
+                        dupe += 1
+                if dupe == 0:
+                    arry.append(tempdoop)
+        reported[0] += 1
+        if reported[0] < len(genomeList):
+            return []
+        presence()
+        return masterSeq.keys()
+
+    # Output FASTA file for a gene family, and align it if asked
+    def family(name):
         outFas = outFile + name + '.fas'
-        SeqIO.write(masterSeq[name], 'fas/' + outFas, 'fasta')
+        fasOut = comp.open(comp.name('fas/' + outFas, 'fas'), 'fas')
+        try:
+            SeqIO.write(masterSeq[name], fasOut, 'fasta')
+        except:
+            fasOut.discard()
+            raise
+        fasOut.close()
         if options.muscle or options.tree or options.xfma:
-            if not os.path.exists('aln'):
-                os.mkdir('aln')
-            if not os.path.exists('phy'):
-                os.mkdir('phy')
             # Create MUSCLE alignment
-            align(outFas, options.write)
+            align(outFas, options.write, comp)
             if options.xfma:
                 # xfmaOut is a standard filestream handler.
                 # alignment is the alignmentIO record from the input file
-                alignment = AlignIO.read(open('aln/' +outFas + ".aln"), 'clustal') 
+                alnIn = openIn(comp.name('aln/' +outFas + ".aln", 'aln'))
+                alignment = AlignIO.read(alnIn, 'clustal') 
+                alnIn.close()
                 # Input alignment is a clustal alignment produced by muscle
                 # Writes the genename as a comment i.e. dnaG.aln -> #dnaG in the file
                 xmfaOut.write('#%s\n' %outFas ) 
@@ -375,15 +279,46 @@ def main():
                 xmfaOut.write('=\n')
             if options.tree and not options.concat:
                 tree('phy/' + outFas + ".phy", RefPro, options.write)
+        return []
+
+    # Each genome is passed convert -> search -> parse -> aggregate through
+    # bounded queues, so GenBank conversion and XML parsing of other genomes
+    # happen while BLAST is running. If any stage fails, abort is set and
+    # the other stages stop (no new BLAST runs are started).
+    abort = threading.Event()
+    stages = [ Stage('convert', lambda genome: [ convertGenome(genome, GBK, RefPro, comp) ], options.queue, abort),
+               Stage('search', lambda job: [ searchGenome(job, refPro, dbtype, GBK, RefPro, Uevalue, comp) ], options.queue, abort),
+               Stage('parse', lambda job: [ parseHits(job, f, GBK, RefPro, identCutoff, lenCutoff) ], options.queue, abort),
+               Stage('aggregate', aggregate, options.queue, abort),
+               Stage('align', family, options.queue, abort) ]
+    for i in range(len(stages) - 1):
+        stages[i].downstream = stages[i + 1]
+    pipeStart = time.time()
+    for stage in stages:
+        stage.start()
+    for genome in genomeList:
+        if abort.is_set():
+            break
+        stages[0].put(genome)
+    stages[0].put(None)
+    joinStages(stages, stages[-3], abort)
+    f.close()
+    joinStages(stages, stages[-1], abort)
+    if not pre.closed:
+        presence()
+    xmfaOut.close()
+    report(stages, time.time() - pipeStart)
     if options.concat:
         # Open muscle alignments
         print 'Concating sequences ' 
         doop = {} 
         for name in masterSeq.keys():
             outAln = outFile + name + '.fas'
-            outAln = 'aln/' + outAln +".aln"
+            outAln = comp.name('aln/' + outAln +".aln", 'aln')
             try:
-                alignment = AlignIO.read(open(outAln), "clustal")
+                alnIn = openIn(outAln)
+                alignment = AlignIO.read(alnIn, "clustal")
+                alnIn.close()
                 if len(alignment) == len(genomeList):
                     for record in alignment:
                         if doop.has_key(record.id):
@@ -398,13 +333,15 @@ def main():
             outgen.append(doop[k])
         outFas = outFile + 'all'
         outgen = [MultipleSeqAlignment(outgen)]
-        AlignIO.write(outgen, outFas + ".phy", "phylip")
-        AlignIO.write(outgen, outFas + ".aln", "clustal")
+        writeAlignment(outgen, outFas + ".phy", "phylip", 'phy', comp)
+        writeAlignment(outgen, outFas + ".aln", "clustal", 'aln', comp)
         if options.tree:
             tree(outFas + ".phy", RefPro)
         if NUMSNPS != None and NUMSNPS > 0 :
             print 'Creating snp file'
-            alignment = AlignIO.read(open(outFas + ".aln"), "clustal")
+            alnIn = openIn(comp.name(outFas + ".aln", 'aln'))
+            alignment = AlignIO.read(alnIn, "clustal")
+            alnIn.close()
             doop = [] 
             print 'reading records'
             for record in alignment:
@@ -434,21 +371,482 @@ def main():
                         seqseq+= al.seq[pos]
                     al.seq = (Seq(seqseq, al.seq.alphabet))
                 doop = [MultipleSeqAlignment(doop)]
-                AlignIO.write(doop, outFas + "snp.phy", 'phylip')
-                AlignIO.write(doop, outFas + "snp.aln", 'clustal')
+                writeAlignment(doop, outFas + "snp.phy", 'phylip', 'phy', comp)
+                writeAlignment(doop, outFas + "snp.aln", 'clustal', 'aln', comp)
                 if options.tree:
                     tree(outFas + "snp.phy", RefPro, options.write)
             else: 
                 print 'WARNING: NO SNPS'
+    comp.report()
+
+
+def convertGenome(genome, GBK, RefPro, comp):
+    # Returns (genome, fasta) where fasta is the file to search. If GBK, the
+    # CDS of the GenBank/EMBL file are converted to faa/fna in temp/ first.
+    print 'reading ' + genome 
+    genome = genome.strip()
+    if not GBK:
+        return genome, genome
+    INEXT = '.gbk'
+    INTYPE = 'genbank'
+    if genome.endswith('.embl'):
+        INEXT = '.embl'
+        INTYPE = 'embl'
+    if RefPro:
+        fasta = comp.name('temp/' + os.path.basename(genome).replace(INEXT,'.faa'), 'temp')
+    else:
+        fasta = comp.name('temp/' + os.path.basename(genome).replace(INEXT,'.fna'), 'temp')
+    print 'checking ' + fasta 
+    if not os.path.exists(fasta) or os.path.getsize(fasta) == 0:
+        input_handle  = open(genome, "r")
+        output_handle = comp.open(fasta, 'temp')
+        print 'Creating fas: ' + fasta 
+        try:
+            for seq_record in SeqIO.parse(input_handle, INTYPE):
+                print "Dealing with GenBank record %s" % seq_record.id
+                for seq_feature in seq_record.features:
+                    if seq_feature.type== "CDS" :
+                        na = ''
+                        labled = True 
+                        if seq_feature.qualifiers.has_key('locus_tag'):
+                            na = seq_feature.qualifiers['locus_tag'][0]  
+                        elif seq_feature.qualifiers.has_key('gene'):
+                            na = seq_feature.qualifiers['gene'][0]
+                        else:
+                            labled = False
+                        if RefPro and labled:
+                            try:
+                                if seq_feature.qualifiers.has_key('pseudo') == False:
+                                    if not seq_feature.qualifiers.has_key('translation'):
+                                        pr = seq_feature.extract(seq_record.seq)
+                                        seq_feature.qualifiers['translation'] = [pr.translate()]
+                                    output_handle.write(">%s|%s [%s]\n%s\n" % (
+                                        na,
+                                        seq_record.name, seq_feature.qualifiers['product'][0],
+                                        seq_feature.qualifiers['translation'][0]))
+                            except Exception as e:
+                                print 'ERROR:' +  str(e)
+                                print seq_feature
+                        elif labled:
+                            try:
+                                descs = 'pseudogene'
+                                if  seq_feature.qualifiers.has_key('product'): 
+                                    descs =  seq_feature.qualifiers['product']
+                                output_handle.write(">%s|%s [%s]\n%s\n" % (
+                                        na,
+                                        seq_record.name, descs,
+                                        seq_feature.extract(seq_record).seq))
+                            except Exception as e:
+                                print 'ERROR ' + str(e)
+                                print seq_feature
+        except:
+            output_handle.discard()
+            input_handle.close()
+            raise
+        output_handle.close()
+        input_handle.close()
+    return genome, fasta
+
+def searchGenome(job, refPro, dbtype, GBK, RefPro, Uevalue, comp):
+    # Run BLASTx if protein ref, BLASTn if nucl ref. If GBK the converted
+    # CDS are searched with BLASTp/BLASTn instead. The query is streamed in
+    # and the XML streamed out through comp. Returns (fasta, blastRes)
+    genome, fasta = job
+    blastRes = comp.name('temp/' + os.path.basename(refPro) + os.path.basename(genome) + dbtype  + '.xml', 'temp')
+    if os.path.exists(blastRes) and os.path.getsize(blastRes) > 0:
+        return fasta, blastRes
+    if GBK and RefPro:
+        cline = NcbiblastpCommandline(seg='no',db=refPro,evalue=Uevalue,outfmt=5,num_threads='8')
+    elif GBK:
+        cline = NcbiblastnCommandline(task='blastn', dust='no',db=refPro,evalue=Uevalue,outfmt=5)
+    elif RefPro:
+        cline = NcbiblastxCommandline(seg='no',  db=refPro, evalue=Uevalue, outfmt=5)
+    else: 
+        cline = NcbiblastnCommandline(dust='no', task='blastn', db=refPro, evalue=Uevalue, outfmt=5)
+    print(str(cline) + ' < ' + fasta + ' > ' + blastRes + '\n')
+    runCommand(cline, fasta, blastRes, 'temp', comp)
+    return fasta, blastRes
+
+class Hit(object):
+    # One HSP row of the table. Only accepted best hits are turned into a
+    # SeqRecord, see parseHits()
+    __slots__ = ('ref', 'desc', 'refLen', 'genome', 'query', 'queryLen',
+                 'ident', 'cover', 'expect', 'refStart', 'refEnd',
+                 'genomeStart', 'genomeEnd', 'score', 'added', 'seq')
+    ROW = '%s\t' * 16 + '\n'
+
+    def __init__(self, ref, desc, refLen, genome, query, queryLen, ident, cover, hsp, added, seq):
+        self.ref = ref
+        self.desc = desc
+        self.refLen = refLen
+        self.genome = genome
+        self.query = query
+        self.queryLen = queryLen
+        self.ident = ident
+        self.cover = cover
+        self.expect = hsp.expect
+        self.refStart = hsp.sbjct_start
+        self.refEnd = hsp.sbjct_end
+        self.genomeStart = hsp.query_start
+        self.genomeEnd = hsp.query_end
+        self.score = hsp.score
+        self.added = added
+        self.seq = seq
+
+    def row(self):
+        return Hit.ROW % (self.ref, self.desc, self.refLen, self.genome,
+                self.query, self.queryLen, int(self.ident), int(self.cover),
+                self.expect, self.refStart, self.refEnd, self.genomeStart,
+                self.genomeEnd, self.score, int(self.added), self.seq)
+
+def parseHits(job, f, GBK, RefPro, identCutoff, lenCutoff):
+    # Writes a table row to f for every HSP. Returns a list of
+    # (ref gene, SeqRecord) for the best hits that pass the cutoffs
+    genome, blastRes = job
+    print 'reading BLAST ' + blastRes
+    result_handle = openIn(blastRes)
+    blast_records = NCBIXML.parse(result_handle)
+    fast = None
+    if GBK:
+        int_handle  = openIn(genome)
+        fast = SeqIO.to_dict(SeqIO.parse(int_handle, "fasta"))
+        int_handle.close()
+        print 'indexed fasta' 
+    best = bestHits(blast_records, fast, genome, f, GBK, RefPro, identCutoff, lenCutoff)
+    result_handle.close()
+    return best
+
+def bestHits(blast_records, fast, genome, f, GBK, RefPro, identCutoff, lenCutoff):
+    # The HSP loop of parseHits(). fast is the indexed query FASTA if GBK
+    genomeName = os.path.basename(genome)
+    genomeId = genomeName.split('.')[0]
+    alphabet = generic_dna
+    if RefPro:
+        alphabet = generic_protein
+    best = []
+    for blast_record in blast_records:
+        query = blast_record.query
+        # If GBK every HSP of a query has the same (whole CDS) sequence,
+        # looked up at the first HSP
+        querySeq = None
+        queryRev = None
+        for alignment in blast_record.alignments:
+            refHead =  alignment.hit_def.split('|')
+            if refHead[0] == 'gi': refHead = refHead[3:] 
+            hits = 0
+            for hsp in alignment.hsps:
+                ident = float(hsp.identities) / float(hsp.align_length) * float(100)
+                cover = float(hsp.align_length) / float(alignment.length) * float(100)
+                if GBK:
+                    if querySeq == None:
+                        querySeq = str(fast[query.split()[0].strip()].seq)
+                    seq = querySeq
+                    if not RefPro and hsp.frame[1] == -1:
+                        if queryRev == None:
+                            queryRev = reverse_complement(querySeq)
+                        seq = queryRev
+                else:
+                    seq = hsp.query
+                    if not RefPro and hsp.frame[1] == -1:
+                        seq = reverse_complement(str(seq))
+                # Grab only first hit, i.e best hit. 
+                added = hits == 0 and ident > float(identCutoff) and cover > lenCutoff
+                hit = Hit(refHead[0], refHead[-1], alignment.length, genomeName,
+                        query, blast_record.query_letters, ident, cover, hsp,
+                        added, seq)
+                f.write(hit.row())
+                if added:
+                    hits += 1
+                    if GBK and RefPro:
+                        rec = SeqRecord(Seq(seq, alphabet), id=genomeId, description=refHead[0], name=refHead[1])
+                    elif GBK or RefPro:
+                        rec = SeqRecord(Seq(seq, alphabet), id=genomeId, description=refHead[0])
+                    else:
+                        rec = SeqRecord(Seq(seq, alphabet), id=genomeId, description=refHead[-1])
+                    best.append((hit.ref, rec))
+    return best
+
+class Stage:
+    # One step of the genome pipeline, run on its own thread. Items are taken
+    # from a bounded queue and each result of fn(item) is put on the
+    # downstream stage's queue. None marks the end of the input. abort is
+    # shared by all stages and set when any of them fails. Keeps the time
+    # spent in fn and the queue depth seen, see report().
+    def __init__(self, name, fn, size, abort):
+        self.name = name
+        self.fn = fn
+        self.abort = abort
+        self.queue = Queue.Queue(size)
+        self.downstream = None
+        self.items = 0
+        self.busy = 0.0
+        self.depthMax = 0
+        self.depthSum = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            depth = self.queue.qsize()
+            item = self.queue.get()
+            if item == None:
+                break
+            # After an error in any stage keep draining, so upstream stages
+            # do not block, but do no more work
+            if self.abort.is_set():
+                continue
+            self.depthMax = max(self.depthMax, depth)
+            self.depthSum += depth
+            start = time.time()
+            try:
+                results = self.fn(item)
+            except Exception as e:
+                print 'ERROR in ' + self.name + ' stage'
+                traceback.print_exc()
+                self.error = e
+                self.abort.set()
+                continue
+            self.busy += time.time() - start
+            self.items += 1
+            if self.downstream != None:
+                for res in results:
+                    self.downstream.put(res)
+        if self.downstream != None:
+            self.downstream.put(None)
+
+def joinStages(stages, last, abort):
+    # Waits for the stages up to and including last to finish. As soon as
+    # any stage has failed, waits only for the items already being worked
+    # on (so no half written files are left in temp/) and raises the error
+    for stage in stages[:stages.index(last) + 1]:
+        while stage.thread.isAlive() and not abort.is_set():
+            stage.thread.join(0.5)
+        if abort.is_set():
+            break
+    if abort.is_set():
+        print 'Waiting for running stages to finish'
+        for stage in stages:
+            stage.thread.join()
+    for stage in stages:
+        if stage.error != None:
+            raise stage.error
+
+def report(stages, wall):
+    # Print utilisation (time in stage / pipeline wall time) and queue depth
+    # for each stage. The busiest stage is the bottleneck
+    print 'Pipeline stages (%.1f s):' % wall
+    print '%-10s %6s %10s %6s %9s %10s' % ('stage', 'items', 'busy (s)', 'util', 'max queue', 'mean queue')
+    for stage in stages:
+        util = 0.0
+        if wall > 0:
+            util = stage.busy / wall * 100
+        mean = 0.0
+        if stage.items > 0:
+            mean = float(stage.depthSum) / stage.items
+        print '%-10s %6d %10.1f %5.1f%% %9d %10.1f' % (stage.name, stage.items, stage.busy, util, stage.depthMax, mean)
+    bottle = max(stages, key=lambda stage: stage.busy)
+    print 'Bottleneck stage: ' + bottle.name
+
+def runCommand(cline, inFile, outFile, kind, comp):
+    # Runs cline with inFile (decompressed if needed) on stdin and writes
+    # stdout to outFile through comp, so nothing is decompressed to disk.
+    # outFile is only put in place if the command succeeds
+    inHandle = openIn(inFile)
+    try:
+        outHandle = comp.open(outFile, kind)
+        proc = None
+        try:
+            proc = subprocess.Popen(str(cline), shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            def feed():
+                try:
+                    shutil.copyfileobj(inHandle, proc.stdin)
+                except IOError:
+                    pass
+                proc.stdin.close()
+            feeder = threading.Thread(target=feed)
+            feeder.start()
+            shutil.copyfileobj(proc.stdout, outHandle)
+            feeder.join()
+            if proc.wait() != 0:
+                raise RuntimeError('%s returned non-zero exit status %d' % (str(cline), proc.returncode))
+        except:
+            if proc != None and proc.poll() == None:
+                proc.kill()
+            outHandle.discard()
+            raise
+        outHandle.close()
+    finally:
+        inHandle.close()
+
+def writeAlignment(alignments, path, format, kind, comp):
+    handle = comp.open(comp.name(path, kind), kind)
+    try:
+        AlignIO.write(alignments, handle, format)
+    except:
+        handle.discard()
+        raise
+    handle.close()
+
+def openIn(path):
+    # Opens path for reading, decompressing gzip or zstd streams as read.
+    # Closing the returned handle closes the file
+    handle = open(path, 'rb')
+    magic = handle.read(4)
+    handle.seek(0)
+    if magic[:2] == '\x1f\x8b':
+        handle.close()
+        return gzip.open(path, 'rb')
+    if magic == '\x28\xb5\x2f\xfd':
+        if zstandard == None:
+            handle.close()
+            raise IOError(path + ' is zstd compressed, but zstandard is not installed')
+        return ZstdReader(handle)
+    return handle
+
+class ZstdReader(io.BufferedReader):
+    # Buffered zstd stream that also closes the file under it
+    def __init__(self, handle):
+        io.BufferedReader.__init__(self, zstandard.ZstdDecompressor().stream_reader(handle))
+        self.handle = handle
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            self.handle.close()
+
+class Compressor:
+    # Opens intermediate and output files for writing, compressed with gzip
+    # or zstd (gzip if zstandard is not installed). Files of a kind listed
+    # in plain are never compressed. Keeps bytes written and time spent per
+    # kind of file (temp, fas, aln, phy), see report().
+    def __init__(self, method, level, plain):
+        if method == 'zstd' and zstandard == None:
+            print 'WARNING: zstandard not installed, using gzip'
+            method = 'gzip'
+        self.method = method
+        self.level = level
+        if level == None and method == 'gzip':
+            self.level = 6
+        elif level == None and method == 'zstd':
+            self.level = 3
+        if method == 'gzip' and not 0 <= self.level <= 9:
+            raise ValueError('gzip compression level must be 0-9, not %d' % self.level)
+        if method == 'zstd' and not 1 <= self.level <= zstandard.MAX_COMPRESSION_LEVEL:
+            raise ValueError('zstd compression level must be 1-%d, not %d' % (zstandard.MAX_COMPRESSION_LEVEL, self.level))
+        self.plain = plain
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def name(self, path, kind):
+        if self.method == None or kind in self.plain:
+            return path
+        if self.method == 'zstd':
+            return path + '.zst'
+        return path + '.gz'
+
+    def open(self, path, kind):
+        # path should come from name(), so the suffix decides the format.
+        # Data goes to path.tmp, which close() renames to path
+        raw = open(path + '.tmp', 'wb')
+        if path.endswith('.gz'):
+            return CountingWriter(self, kind, path, raw, gzip.GzipFile(path, 'wb', self.level, raw))
+        if path.endswith('.zst'):
+            return CountingWriter(self, kind, path, raw, zstandard.ZstdCompressor(level=self.level).stream_writer(raw))
+        return CountingWriter(self, kind, path, raw, raw)
+
+    def add(self, kind, written, size, secs):
+        self.lock.acquire()
+        files, allWritten, allSize, allSecs = self.stats.get(kind, (0, 0, 0, 0.0))
+        self.stats[kind] = (files + 1, allWritten + written, allSize + size, allSecs + secs)
+        self.lock.release()
 
-        
-def align(fas, clean):
-    if not os.path.exists( 'aln/' + fas +".aln") or clean:
-        cmdline = MuscleCommandline(input='fas/' + fas, out='aln/' + fas + ".aln", clw=True)
-        print(str(cmdline) + '\n')
-        cmdline()
+    def report(self):
+        # Uncompressed bytes, bytes on disk and time spent writing per kind
+        method = self.method
+        if method == None:
+            method = 'none'
+        else:
+            method += ' level ' + str(self.level)
+        print 'Output files (compression: %s):' % method
+        print '%-6s %6s %12s %12s %6s %9s' % ('kind', 'files', 'data (MB)', 'disk (MB)', 'ratio', 'write (s)')
+        for kind in sorted(self.stats.keys()):
+            files, written, size, secs = self.stats[kind]
+            ratio = 0.0
+            if size > 0:
+                ratio = float(written) / size
+            print '%-6s %6d %12.1f %12.1f %6.2f %9.1f' % (kind, files, written / 1e6, size / 1e6, ratio, secs)
+
+class CountingWriter:
+    # Write handle that counts the (uncompressed) bytes and time written.
+    # Writes to path.tmp; close() puts the finished file at path, discard()
+    # removes it, so an interrupted write never looks like a finished file
+    def __init__(self, comp, kind, path, raw, handle):
+        self.comp = comp
+        self.kind = kind
+        self.path = path
+        self.raw = raw
+        self.handle = handle
+        self.written = 0
+        self.secs = 0.0
+
+    def write(self, data):
+        start = time.time()
+        self.handle.write(data)
+        self.secs += time.time() - start
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        start = time.time()
+        if self.path.endswith('.zst'):
+            self.handle.flush(zstandard.FLUSH_FRAME)
+        elif self.handle != self.raw:
+            self.handle.close()
+        self.raw.close()
+        os.rename(self.path + '.tmp', self.path)
+        self.secs += time.time() - start
+        self.comp.add(self.kind, self.written, os.path.getsize(self.path), self.secs)
+
+    def discard(self):
+        # Errors closing a broken stream are ignored, so the caller can
+        # raise the error that caused the discard
+        try:
+            if self.handle != self.raw and not self.path.endswith('.zst'):
+                self.handle.close()
+        except Exception:
+            pass
+        self.raw.close()
+        os.remove(self.path + '.tmp')
+
+def align(fas, clean, comp):
+    aln = comp.name('aln/' + fas + ".aln", 'aln')
+    if not os.path.exists(aln) or clean:
+        cmdline = MuscleCommandline(clw=True)
+        print(str(cmdline) + ' < ' + comp.name('fas/' + fas, 'fas') + ' > ' + aln + '\n')
+        runCommand(cmdline, comp.name('fas/' + fas, 'fas'), aln, 'aln', comp)
     try:
-        AlignIO.convert( 'aln/' + fas +".aln", "clustal", 'phy/' + fas + ".phy", "phylip")
+        alnIn = openIn(aln)
+        try:
+            phyOut = comp.open(comp.name('phy/' + fas + ".phy", 'phy'), 'phy')
+            try:
+                AlignIO.convert(alnIn, "clustal", phyOut, "phylip")
+            except:
+                # Do not leave a half written phylip file behind
+                phyOut.discard()
+                raise
+            phyOut.close()
+        finally:
+            alnIn.close()
     except Exception as e :
         print 'WARNING: BAD ALIGNMENT'
         print e
@@ -494,6 +892,9 @@ if __name__ == '__main__':
         parser.add_option('-o', '--output', action='store', type='string',dest='out', help='output prefix')
         parser.add_option('-n', '--numsnps', action='store', type='int', help='minimum number of snps')
         parser.add_option('-w', '--write', action='store_true', default=False, help='Overwrite all files')
+        parser.add_option('-z', '--compress', action='store', type='choice', choices=['gzip', 'zstd'], help='compress intermediate and output files (gzip or zstd)')
+        parser.add_option('-L', '--level', action='store', type='int', help='compression level')
+        parser.add_option('-q', '--queue', action='store', type='int', default=2, help='maximum items queued between pipeline stages')
         (options, args) = parser.parse_args()
         if options.verbose:
             print "Executing @ " + time.asctime()
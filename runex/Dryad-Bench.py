@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+# Created: Mon, 19 Oct 2026 10:12:41 +1000
+
+Microbenchmark of the Dryad HSP loop. Just run 'python Dryad-Bench.py -x \
+        temp/<result>.xml'. Reports HSPs/second for the old and current \
+        loop on a recorded BLAST result.
+
+Dependencies include:
+* Biopython
+Be sure these are installed and on your path.
+
+This script reads a BLAST XML result left in temp/ by a Dryad run, parses it
+once into memory and then times the loop that builds the table rows and best
+hits, so XML parsing is not part of the timing. The old loop is the one from
+before the Hit record (one SeqRecord per HSP, rows joined with +=). Both
+loops must produce the same table, or the benchmark stops.
+
+For results from a '-g' run give the converted genome with '-f', e.g:
+    python Dryad-Bench.py -x temp/refs.faaU00096.gbkprot.xml \
+        -f temp/U00096.faa -p
+"""
+import sys, os, traceback, argparse
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Dryad
+from Dryad import Seq, SeqRecord, SeqIO, NCBIXML, generic_protein, generic_dna
+
+__author__ = "Nabil-Fareed Alikhan"
+__licence__ = "GPLv3"
+__version__ = "0.3"
+__email__ = "n.alikhan@uq.edu.au"
+epi = "Licence: "+ __licence__ +  " by " + __author__ + " <" + __email__ + ">"
+
+def main ():
+    global args
+    GBK = args.fasta != None
+    print 'Reading %s' %(args.xml)
+    handle = Dryad.openIn(args.xml)
+    records = list(NCBIXML.parse(handle))
+    handle.close()
+    fast = None
+    genome = args.xml
+    if GBK:
+        handle = Dryad.openIn(args.fasta)
+        fast = SeqIO.to_dict(SeqIO.parse(handle, "fasta"))
+        handle.close()
+        genome = args.fasta
+    hsps = 0
+    for record in records:
+        for alignment in record.alignments:
+            hsps += len(alignment.hsps)
+    print '%d queries, %d HSPs' %(len(records), hsps)
+
+    # Both loops must write the same table and keep the same best hits
+    old, new = StringIO(), StringIO()
+    oldBest = oldBestHits(records, fast, genome, old, GBK, args.protein, args.id, args.len)
+    newBest = Dryad.bestHits(records, fast, genome, new, GBK, args.protein, args.id, args.len)
+    if old.getvalue() != new.getvalue():
+        print 'ERROR: table rows differ'
+        sys.exit(1)
+    if [(n, str(r.seq), r.id, r.description) for n, r in oldBest] != \
+            [(n, str(r.seq), r.id, r.description) for n, r in newBest]:
+        print 'ERROR: best hits differ'
+        sys.exit(1)
+
+    # Old loop wrote through a default buffered file, new one through 1 MB
+    for name, loop, buf in [('old', oldBestHits, -1), ('new', Dryad.bestHits, 1 << 20)]:
+        times = []
+        for i in range(args.repeat):
+            f = open(os.devnull, 'w', buf)
+            start = time.time()
+            loop(records, fast, genome, f, GBK, args.protein, args.id, args.len)
+            f.close()
+            times.append(time.time() - start)
+        secs = min(times)
+        print '%s: %.3f s, %.0f HSPs/s (best of %d)' %(name, secs, hsps / secs, args.repeat)
+
+def oldBestHits(blast_records, fast, genome, f, GBK, RefPro, identCutoff, lenCutoff):
+    best = []
+    for blast_record in blast_records:
+        for alignment in blast_record.alignments:
+            hits = 0
+            for hsp in alignment.hsps:
+                outLine  = []
+                refHead =  alignment.hit_def.split('|')
+                if refHead[0] == 'gi': refHead = refHead[3:]
+                tempdoop = None
+                if GBK and RefPro:
+                    tempse = fast[blast_record.query.split()[0].strip()]
+                    tempdoop = SeqRecord(Seq(str(tempse.seq),generic_protein),id=os.path.basename(genome).split('.')[0],description=refHead[0],name=refHead[1])
+                elif GBK and not RefPro:
+                    tempse = fast[blast_record.query.split()[0].strip()]
+                    seqseq = Seq(str(tempse.seq), generic_dna)
+                    if hsp.frame[1] == -1:
+                        seqseq = seqseq.reverse_complement()
+                    tempdoop = SeqRecord(seqseq,id=os.path.basename(genome).split('.')[0],description=refHead[0])
+                elif not GBK and  RefPro:
+                    tempdoop = SeqRecord(Seq(hsp.query, generic_protein), id=os.path.basename(genome).split('.')[0],description=refHead[0] )
+                else:
+                    seqseq = Seq(hsp.query,generic_dna)
+                    if hsp.frame[1] == -1:
+                        seqseq = seqseq.reverse_complement()
+                    tempdoop = SeqRecord(seqseq, id=os.path.basename(genome).split('.')[0],description=refHead[-1])
+                outLine.append(refHead[0])
+                outLine.append(refHead[-1])
+                outLine.append(alignment.length)
+                outLine.append(os.path.basename(genome))
+                outLine.append(blast_record.query)
+                outLine.append(blast_record.query_letters)
+                outLine.append(int(float(hsp.identities) / float(hsp.align_length) * float(100)))
+                outLine.append(int(float(hsp.align_length) / float(alignment.length) * float(100)))
+                outLine.append(hsp.expect)
+                outLine.append(hsp.sbjct_start)
+                outLine.append(hsp.sbjct_end)
+                outLine.append(hsp.query_start)
+                outLine.append(hsp.query_end)
+                outLine.append(hsp.score)
+                if ( hits == 0 and float(hsp.identities) / float(hsp.align_length) * float(100)  ) > float(identCutoff) \
+                        and ( float(hsp.align_length) / float(alignment.length) * float(100) > lenCutoff):
+                    hits += 1
+                    outLine.append('1')
+                    best.append((outLine[0], tempdoop))
+                else:
+                    outLine.append('0')
+                if tempdoop is not None:
+                    outLine.append( tempdoop.seq )
+                deg = ''
+                for el in outLine:
+                    deg += str(el) + '\t'
+                f.write(deg + '\n')
+    return best
+
+if __name__ == '__main__':
+    try:
+        start_time = time.time()
+        desc = __doc__.split('\n\n')[1].strip()
+        parser = argparse.ArgumentParser(description=desc,epilog=epi)
+        parser.add_argument ('-v', '--verbose', action='store_true', default=False, help='verbose output')
+        parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
+        parser.add_argument ('-x', '--xml', required=True, action='store', help='BLAST XML result (can be compressed)')
+        parser.add_argument ('-f', '--fasta', action='store', help='Converted genome FASTA, for results from a -g run')
+        parser.add_argument ('-p', '--protein', action='store_true', default=False, help='Protein reference genes')
+        parser.add_argument ('-i', '--id', action='store', type=int, default=70, help='minimum percent identity [Default: 70]')
+        parser.add_argument ('-l', '--len', action='store', type=int, default=70, help='minimum percent match for length [Default: 70]')
+        parser.add_argument ('-n', '--repeat', action='store', type=int, default=5, help='timed runs of each loop [Default: 5]')
+        args = parser.parse_args()
+        if args.verbose: print "Executing @ " + time.asctime()
+        main()
+        if args.verbose: print "Ended @ " + time.asctime()
+        if args.verbose: print 'total time in minutes:',
+        if args.verbose: print (time.time() - start_time) / 60.0
+        sys.exit(0)
+    except KeyboardInterrupt, e: # Ctrl-C
+        raise e
+    except SystemExit, e: # sys.exit()
+        raise e
+    except Exception, e:
+        print 'ERROR, UNEXPECTED EXCEPTION'
+        print str(e)
+        traceback.print_exc()
+        os._exit(1)